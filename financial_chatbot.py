@@ -3,26 +3,40 @@
 # Uses a hardcoded User ID from .env for all database operations. 
 
 # --- Core Libraries ---
+import asyncio
+import logging
 import os
 import re
+import sqlite3
+import time
 import warnings
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 # --- LangChain & AI ---
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_community.utilities import SQLDatabase
 from langchain_community.agent_toolkits import SQLDatabaseToolkit
+from langchain_community.tools.sql_database.tool import QuerySQLDataBaseTool
+from langchain_community.agent_toolkits.sql.prompt import SQL_PREFIX
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import Runnable
 from langchain.agents import create_sql_agent, AgentExecutor
+from langchain.memory import ConversationBufferWindowMemory
 
 # --- Database ---
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
 
 # --- Web Framework & Utils ---
 import uvicorn
 from fastapi import FastAPI, HTTPException # Removed Header import
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 # --- Removed Supabase Auth ---
 # from supabase import create_client, Client # No longer needed for auth
@@ -33,6 +47,67 @@ print("Loading environment variables and libraries...")
 # --- Environment Variable Loading ---
 load_dotenv()
 
+# --- LLM Response Cache (general branch ONLY) ---
+# Repeated general-finance questions (e.g. "What is compound interest?") get
+# answered locally instead of paying the full Gemini round-trip.
+# Preferred: a semantic cache (GPTCache + ONNX MiniLM embeddings + FAISS) so
+# paraphrases ("What is compound interest?" vs "Explain compound interest.")
+# also hit. Falls back to an exact-match SQLiteCache if gptcache is not
+# installed. The cache is attached per-model to the general-branch LLM
+# rather than set globally: the SQL agent works on query-dependent,
+# user-specific data, where a >=0.9-similarity hit ("total spent on food"
+# vs "total spent on fuel", or the same question after the data changed)
+# would replay a stale or wrong generation mid tool-loop.
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", ".semantic_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.9
+
+
+def _init_gptcache(cache_obj, llm_string: str):
+    """ Per-LLM GPTCache init: MiniLM embeddings + FAISS index persisted to disk. """
+    from gptcache import Config
+    from gptcache.adapter.api import init_similar_cache
+    from gptcache.processor.pre import get_prompt
+
+    init_similar_cache(
+        cache_obj=cache_obj,
+        data_dir=os.path.join(SEMANTIC_CACHE_DIR, llm_string.replace("/", "_")[:64]),
+        pre_func=lambda data, **params: get_prompt(data, **params).strip().lower(),
+        # Only return a hit when cosine similarity clears the threshold.
+        config=Config(similarity_threshold=SEMANTIC_CACHE_THRESHOLD),
+    )
+
+
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", ".chatbot_cache.db")
+
+
+def _prune_llm_cache(database_path: str, max_age_days: int = 30) -> None:
+    """ Drops the persistent cache file if it hasn't been written to in
+    max_age_days. SQLiteCache stores no per-entry timestamps, so staleness
+    is judged by file mtime (updated on every cache write). """
+    try:
+        if os.path.exists(database_path):
+            age_seconds = time.time() - os.path.getmtime(database_path)
+            if age_seconds > max_age_days * 86400:
+                os.remove(database_path)
+                print(f"   Pruned stale LLM cache file (unused for >{max_age_days} days): {database_path}")
+    except OSError as e:
+        print(f"⚠️ Could not prune LLM cache file {database_path}: {e}")
+
+
+try:
+    from langchain_community.cache import GPTCache
+    GENERAL_LLM_CACHE = GPTCache(_init_gptcache)
+    print(f"✅ Semantic LLM cache enabled for the general branch (GPTCache, threshold={SEMANTIC_CACHE_THRESHOLD}, dir={SEMANTIC_CACHE_DIR}).")
+except ImportError:
+    # The general-finance query distribution is heavy-tailed: a handful of
+    # questions repeat across users and sessions, so the fallback cache
+    # should survive restarts/deploys instead of cold-starting each boot.
+    # ~5ms SQLite lookup per hit beats a 1-3s Gemini call.
+    from langchain_community.cache import SQLiteCache
+    _prune_llm_cache(LLM_CACHE_DB)
+    GENERAL_LLM_CACHE = SQLiteCache(database_path=LLM_CACHE_DB)
+    print(f"⚠️ gptcache not installed - falling back to persistent exact-match SQLite LLM cache for the general branch ({LLM_CACHE_DB}).")
+
 # --- Configuration ---
 # Google AI
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
@@ -44,6 +119,18 @@ SUPABASE_DB_USER = os.getenv("SUPABASE_DB_USER", "postgres")
 SUPABASE_DB_NAME = os.getenv("SUPABASE_DB_NAME", "postgres")
 # Hardcoded User ID for Testing
 TEST_USER_ID = os.getenv("TEST_USER_ID") # Load the hardcoded User ID
+# Agent verbosity (tool calls, intermediate steps) - off by default: the
+# synchronous stdout writes are a contention point on the hot path.
+AGENT_VERBOSE = os.getenv("AGENT_VERBOSE", "false").lower() == "true"
+
+# --- Logging (hot path) ---
+# Request-path logging goes through the logging module instead of print(),
+# which acquires a global lock and flushes stdout synchronously,
+# serializing requests under load. Uvicorn only attaches handlers to its
+# own uvicorn.* loggers, so give the root logger a handler at INFO -
+# otherwise every logger.info below is silently dropped.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
 
 # --- Critical Configuration Validation ---
 # Removed SUPABASE_URL, SUPABASE_ANON_KEY from checks
@@ -66,96 +153,239 @@ print("✅ Environment variables loaded.")
 print(f"   Using DB: postgresql+psycopg2://{SUPABASE_DB_USER}:***@{SUPABASE_DB_HOST}:{SUPABASE_DB_PORT}/{SUPABASE_DB_NAME}")
 print(f"❗ WARNING: Using hardcoded User ID for ALL requests: {TEST_USER_ID}")
 
+# --- User-Scoped SQL Tooling ---
+class UserScopedSQLQueryTool(QuerySQLDataBaseTool):
+    """ sql_db_query variant that binds the user's UUID server-side.
+
+    The agent writes queries against the `:user_id` placeholder; the real
+    UUID is bound as a query parameter here and never appears in the
+    prompt, so the agent spends no reasoning on extracting it and a
+    malformed query can't leak another user's rows.
+    """
+
+    def _run(self, query: str, run_manager=None) -> str:
+        if ":user_id" not in query:
+            return ("Error: the query must filter by the bind parameter :user_id "
+                    "(e.g. WHERE user_id = :user_id). Rewrite the query and try again.")
+        try:
+            with self.db._engine.connect() as connection:
+                result = connection.execute(text(query), {"user_id": TEST_USER_ID})
+                return str(result.fetchall()) if result.returns_rows else ""
+        except Exception as e:
+            return f"Error: {e}"
+
+
+class UserScopedSQLToolkit(SQLDatabaseToolkit):
+    """ SQLDatabaseToolkit with server-side user scoping.
+
+    Swaps sql_db_query for UserScopedSQLQueryTool and drops
+    sql_db_query_checker - with the UUID bound server-side the extra
+    double-check Gemini round-trip (~500ms-1s per DB query) buys nothing.
+    """
+
+    def get_tools(self):
+        tools = []
+        for tool in super().get_tools():
+            if tool.name == "sql_db_query_checker":
+                continue
+            if tool.name == "sql_db_query":
+                tool = UserScopedSQLQueryTool(db=self.db, description=tool.description)
+            tools.append(tool)
+        return tools
+
+
 # --- Global Variables for Initialized Components ---
 llm: Optional[ChatGoogleGenerativeAI] = None
+llm_fast: Optional[ChatGoogleGenerativeAI] = None
+general_chain: Optional[Runnable] = None
 db: Optional[SQLDatabase] = None
+async_engine: Optional[AsyncEngine] = None
 toolkit: Optional[SQLDatabaseToolkit] = None
 agent_executor: Optional[AgentExecutor] = None
 # supabase_client: Optional[Client] = None # Removed Supabase client variable
-_SQL_AGENT_SUFFIX: str = ""
 
-# --- Initialization Block (Run Once on Startup) ---
-try:
-    # 1. Initialize LLM (No change)
+# --- Agent Instructions (Suffix) ---
+# Kept deliberately short: this text is resent on EVERY agent tool
+# iteration, so each token here costs input tokens x iterations x
+# requests. Routing (DB vs general) is already decided by the 'DB:'
+# prefix before the agent runs, and user scoping is enforced
+# server-side, so only the filter rule and response style remain.
+_SQL_AGENT_SUFFIX = """
+SECURITY MANDATE: Every query passed to `sql_db_query` MUST filter by the bind parameter `:user_id` (bound server-side - never use a literal user ID):
+`WHERE id = :user_id` for `public.profiles`; `WHERE user_id = :user_id` for `public.expense_categories`, `public.expenses`, `public.savings_goals`.
+
+The user is asking about their own financial data. Query only necessary columns, answer based only on the returned data, handle errors gracefully, and keep a clear, encouraging, advisory tone.
+"""
+
+
+# --- Agent Construction & Per-Session Memory ---
+def _create_agent_executor(memory: Optional[ConversationBufferWindowMemory] = None) -> AgentExecutor:
+    """ Builds the SQL agent executor, optionally wired with conversational
+    memory. With memory, follow-up questions see the last k turns and skip
+    redundant schema/table re-discovery reasoning. """
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", SQL_PREFIX.format(dialect=db.dialect, top_k=10) + "\n" + _SQL_AGENT_SUFFIX),
+        MessagesPlaceholder(variable_name="chat_history", optional=True),
+        # Few-shot NLQ->SQL examples ride in their own slot so they reach
+        # the model without being persisted into conversation memory.
+        MessagesPlaceholder(variable_name="nlq_examples", optional=True),
+        ("human", "{input}"),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ])
+    return create_sql_agent(
+        llm=llm,
+        toolkit=toolkit,
+        verbose=AGENT_VERBOSE,
+        agent_type="tool-calling",
+        prompt=prompt,
+        handle_parsing_errors=True,
+        agent_executor_kwargs={
+            # Expose tool calls so successful NLQ->SQL pairs can be memorized.
+            "return_intermediate_steps": True,
+            **({"memory": memory} if memory is not None else {}),
+        },
+    )
+
+
+# Session-scoped agents (LRU-evicted). Each keeps a k=4 window of the
+# conversation so follow-ups cost 1-3 fewer Gemini tool-call round-trips.
+_SESSION_AGENTS: "OrderedDict[str, AgentExecutor]" = OrderedDict()
+_MAX_SESSIONS = 100
+
+
+def _get_agent_for_session(session_id: Optional[str]) -> Optional[AgentExecutor]:
+    """ Returns the memory-backed agent for a session, or the shared
+    stateless agent when no session_id was supplied. """
+    if not session_id:
+        return agent_executor
+    if session_id in _SESSION_AGENTS:
+        _SESSION_AGENTS.move_to_end(session_id)
+    else:
+        if len(_SESSION_AGENTS) >= _MAX_SESSIONS:
+            _SESSION_AGENTS.popitem(last=False)
+        # input_key pins memory to the user's question; the nlq_examples
+        # input must not be replayed as conversation history.
+        memory = ConversationBufferWindowMemory(memory_key="chat_history", k=4, return_messages=True, input_key="input", output_key="output")
+        _SESSION_AGENTS[session_id] = _create_agent_executor(memory)
+    return _SESSION_AGENTS[session_id]
+
+# --- Component Initialization (run from the lifespan handler) ---
+def _init_llms():
+    """ Constructs both Gemini clients.
+
+    transport="grpc_asyncio" keeps all async Gemini calls on one
+    persistent HTTP/2-multiplexed channel instead of paying TLS
+    handshake costs (~100-200ms) on cold connections. """
+    global llm, llm_fast, general_chain
+
+    # cache=False: the agent branch answers from query-dependent,
+    # user-specific data and must never replay a cached generation.
     print("Initializing LLM (gemini-1.5-flash-latest)...")
-    llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash-latest", temperature=0.1)
+    llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash-latest", temperature=0.1, transport="grpc_asyncio", cache=False)
     print("✅ LLM Initialized.")
 
-    # 2. Create Database Connection URI (No change)
+    # Smaller/faster model for the general branch - its answers are capped
+    # at 4 lines, where flash-8b gives ~2x throughput at the same API.
+    # Only this model gets the (semantic) response cache.
+    print("Initializing fast LLM (gemini-1.5-flash-8b)...")
+    llm_fast = ChatGoogleGenerativeAI(model="gemini-1.5-flash-8b", temperature=0.1, transport="grpc_asyncio", cache=GENERAL_LLM_CACHE)
+    print("✅ Fast LLM Initialized.")
+
+    # Pre-compiled prompt | fast LLM pipeline for the general branch.
+    general_chain = GENERAL_PROMPT | llm_fast
+    print("✅ General chain built.")
+
+
+def _init_db():
+    """ Builds both DB engines, the LangChain SQLDatabase, and the cached
+    table info. Blocking (psycopg2 + schema probes) - run in a thread. """
+    global db, async_engine
+
     print("Creating DB Connection URI...")
     db_uri = f"postgresql+psycopg2://{SUPABASE_DB_USER}:{SUPABASE_DB_PASSWORD}@{SUPABASE_DB_HOST}:{SUPABASE_DB_PORT}/{SUPABASE_DB_NAME}"
     print("✅ DB URI Created.")
 
-    # 3. Initialize LangChain SQLDatabase (No change)
+    # Async engine (asyncpg) for DB calls made directly from the event loop.
+    # LangChain's SQLDatabaseToolkit only speaks sync SQLAlchemy, so the
+    # toolkit keeps the psycopg2 engine below; everything else should use
+    # this engine so concurrent /chat requests can interleave their SQL
+    # instead of blocking the loop.
+    print("Creating async DB engine (asyncpg)...")
+    async_db_uri = f"postgresql+asyncpg://{SUPABASE_DB_USER}:{SUPABASE_DB_PASSWORD}@{SUPABASE_DB_HOST}:{SUPABASE_DB_PORT}/{SUPABASE_DB_NAME}"
+    async_engine = create_async_engine(async_db_uri, pool_size=10, max_overflow=20, pool_pre_ping=True)
+    print("✅ Async DB engine created.")
+
+    # Sync engine with explicit pool tuning. Supabase's pooler drops idle
+    # connections, so pre-ping + recycle keep the sql_db_query path on warm
+    # connections instead of paying ~100ms reconnects. statement_timeout
+    # guards against a runaway LLM-generated query pinning a worker.
     print("Connecting to Database via SQLAlchemy...")
     include_tables = ["profiles", "expense_categories", "expenses", "savings_goals"]
-    db = SQLDatabase.from_uri(db_uri, include_tables=include_tables, sample_rows_in_table_info=2)
+    engine = create_engine(
+        db_uri,
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        connect_args={"connect_timeout": 5, "options": "-c statement_timeout=10000"},
+    )
+    db = SQLDatabase(engine=engine, include_tables=include_tables, sample_rows_in_table_info=2)
     print(f"✅ SQLDatabase connection established.")
 
-    # 4. Define Agent Instructions (Suffix - Kept same as before, expecting prefix)
-    # The agent logic will prepend the HARDCODED TEST_USER_ID to the input.
-    print("Defining Agent Suffix/Instructions...")
-    _SQL_AGENT_SUFFIX = """
-TOOLS:
-------
-You have access to ONE tool named `sql_db_query` for querying the user's personal financial database. Use this tool ONLY as instructed below.
-
-USER CONTEXT & SECURITY MANDATE (for SQL Tool):
------------------------------------------------
-The user's query about their personal data will be prefixed with 'UserID [USER_ID_UUID]:'.
-**You MUST extract the USER_ID_UUID from the beginning of the input query.**
-**You MUST use this extracted USER_ID_UUID to filter queries** on relevant tables:
-Use `WHERE id = '[EXTRACTED_USER_ID_UUID]'` for `public.profiles`.
-Use `WHERE user_id = '[EXTRACTED_USER_ID_UUID]'` for `public.expense_categories`, `public.expenses`, `public.savings_goals`.
-**CRITICAL (SQL Tool): Do NOT query data for any other user_id.** If the UserID prefix is missing for a database query, state that you cannot proceed without user context.
-
-*** TASK ROUTING & RESPONSE INSTRUCTIONS ***
---------------------------------------------
-**1. Analyze the User's Query (the part AFTER the 'UserID [...]' prefix if present):** Determine the *type* of question:
-    * **Type A: Personal Data Query:** Does it ask about the user's *specific* financial details stored in the database? These require using the `sql_db_query` tool.
-    * **Type B: General Finance Question:** Is it a request for general financial knowledge, definitions, advice, tips, or explanations? These do **NOT** use the database tool.
-
-**2. Execute Based on Type:**
-    * **If Type A (Personal Data):**
-        * Extract the USER_ID_UUID from the input prefix.
-        * Use the `sql_db_query` tool.
-        * Construct an accurate PostgreSQL query, ensuring you include the **mandatory filter using the extracted user ID**. Query only necessary columns.
-        * Formulate your response based *only* on the data returned by the query. Handle errors gracefully.
-    * **If Type B (General Finance):**
-        * **DO NOT use the `sql_db_query` tool.**
-        * Answer the question directly using your own extensive financial knowledge base.
-        * **Keep your answer concise and focused, aiming for a maximum of 4 lines.**
-        * DO NOT just say "I don't know".
-
-**3. General Response Style:** Maintain a clear, encouraging, and advisory tone. Be accurate.
-"""
-    print("✅ Agent Suffix Defined (still expects UserID in input).")
+    # Cache schema introspection. include_tables is fixed and the schema
+    # is stable, so fetch the table info once and pin it - the agent's
+    # sql_db_schema tool otherwise re-queries information_schema on the
+    # first tool call of each turn (~50-200ms on the pooler).
+    print("Caching table info...")
+    _CACHED_TABLE_INFO = db.get_table_info()
+    db.get_table_info = lambda table_names=None: _CACHED_TABLE_INFO
+    print("✅ Table info cached.")
+
+
+def _init_agent():
+    """ Builds the SQL toolkit and the shared agent executor.
+    Requires _init_llms and _init_db to have completed. """
+    global toolkit, agent_executor
 
-    # 5. Create SQL Toolkit (No change)
     print("Creating SQL Toolkit...")
-    toolkit = SQLDatabaseToolkit(db=db, llm=llm)
+    toolkit = UserScopedSQLToolkit(db=db, llm=llm)
     print("✅ SQL Toolkit Created.")
 
-    # 6. Create Agent Executor (No change)
     print("Creating Agent Executor ('tool-calling')...")
-    agent_executor = create_sql_agent(
-        llm=llm,
-        toolkit=toolkit,
-        verbose=True,
-        agent_type="tool-calling",
-        suffix=_SQL_AGENT_SUFFIX,
-        handle_parsing_errors=True
-    )
+    agent_executor = _create_agent_executor()
     print("✅ Agent Executor Created.")
 
-except Exception as e:
-    print(f"❌ FATAL ERROR during component initialization: {e}")
-    # Set components to None to prevent server start
-    llm = None
-    db = None
-    toolkit = None
-    agent_executor = None
-    # supabase_client = None # Removed
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ Startup/shutdown lifecycle. LLM and DB init are independent, so they
+    run concurrently - DB init (connect + 4 sample-row schema probes) no
+    longer serializes behind LLM construction, cutting cold-start roughly
+    from ~2s to the duration of the slower of the two. """
+    global llm, llm_fast, general_chain, db, async_engine, toolkit, agent_executor
+
+    try:
+        await asyncio.gather(asyncio.to_thread(_init_llms), asyncio.to_thread(_init_db))
+        _init_agent()
+        print("✅ All components initialized successfully.")
+    except Exception as e:
+        print(f"❌ FATAL ERROR during component initialization: {e}")
+        # Leave components unset; endpoints answer 503 until restart.
+        llm = None
+        llm_fast = None
+        general_chain = None
+        db = None
+        async_engine = None
+        toolkit = None
+        agent_executor = None
+
+    yield
+
+    # --- Shutdown: release pooled connections ---
+    if async_engine is not None:
+        await async_engine.dispose()
+    if db is not None:
+        db._engine.dispose()
 
 # --- FastAPI Application Setup ---
 print("Setting up FastAPI application...")
@@ -163,19 +393,250 @@ app = FastAPI(
     title="Financial Chatbot API (Hardcoded User Mode)",
     description="API endpoint for the personal finance chatbot. WARNING: Uses a single hardcoded User ID for all requests.",
     version="1.0.0-test",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,  # orjson serializes ~3-5x faster than stdlib json
 )
 
 # CORS Configuration (No change)
 origins = ["http://localhost", "http://localhost:3000", "http://localhost:5173", "http://localhost:8080"]
 app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["POST", "GET"], allow_headers=["*"])
 
-# --- API Request/Response Models (No change) ---
+# --- API Request/Response Models ---
 class ChatRequest(BaseModel):
     query: str
+    session_id: Optional[str] = None  # enables conversational memory for follow-ups
+    stream: bool = False  # opt into SSE token streaming for general questions
 
 class ChatResponse(BaseModel):
     response: str
 
+class ChatBatchRequest(BaseModel):
+    queries: List[str]
+
+class ChatBatchResponse(BaseModel):
+    responses: List[str]
+
+# --- Concurrency Guard ---
+# Caps in-flight Gemini calls per worker so bursts of concurrent requests
+# (or a big /chat_batch) stay inside the API rate limit.
+_GEMINI_SEM = asyncio.Semaphore(16)
+
+# --- Input Guards ---
+# Short-circuit whitespace, bare greetings, and obviously hostile DB input
+# before they cost a full Gemini round-trip.
+_GREETINGS = {"hi", "hello", "hey"}
+_SQL_INJECTION_RE = re.compile(r";\s*(drop|delete|update|insert|alter|truncate)\b", re.IGNORECASE)
+_MAX_DB_QUERY_CHARS = 500
+
+# Upper bound on what a single query may spend in Gemini input tokens -
+# a pasted 50KB blob otherwise costs ~10s of latency and real money.
+MAX_QUERY_CHARS = 2000
+MAX_QUERY_TOKENS = 500
+
+
+def _estimate_tokens(text_value: str) -> int:
+    """ Rough BPE token estimate (~4/3 tokens per word heuristic). """
+    return int(len(text_value.split()) * 4 / 3)
+
+
+def _query_over_budget(user_query: str) -> bool:
+    return len(user_query) > MAX_QUERY_CHARS or _estimate_tokens(user_query) > MAX_QUERY_TOKENS
+
+
+def _trivial_response(user_query: str) -> Optional[str]:
+    """ Returns a canned reply for empty/greeting-only input, else None. """
+    if len(user_query) < 3:
+        return ("Please ask a full question - e.g. 'What is an emergency fund?' "
+                "or 'DB: how much did I spend this month?'.")
+    if user_query.lower() in _GREETINGS:
+        return ("Hello! Ask me a general finance question, or start with 'DB:' "
+                "to ask about your own financial data.")
+    return None
+
+
+def _invalid_db_query_response(db_query: str) -> Optional[str]:
+    """ Returns a rejection message for suspicious/oversized DB questions, else None. """
+    if len(db_query) > _MAX_DB_QUERY_CHARS or _SQL_INJECTION_RE.search(db_query):
+        return ("That doesn't look like a question about your data. "
+                "Please rephrase it as a short, plain-language question.")
+    return None
+
+
+# --- General-Finance Prompt (compiled once) ---
+# Built at module scope and piped into the fast LLM during init. A stable
+# prompt template keeps the LLM-cache key stable and gives one Runnable
+# path that supports streaming, caching, and batching uniformly.
+GENERAL_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are a concise financial assistant. Answer the user's financial question with a helpful summary within a maximum of 4 lines."),
+    ("human", "{question}"),
+])
+
+
+# --- NLQ->SQL Few-Shot Memory ---
+# Successful (natural question -> generated SQL) pairs are persisted and
+# replayed as in-context examples on similar future questions, so the
+# agent starts from a working query instead of re-deriving SQL from
+# scratch - typically halving tool-call iterations on recurring questions.
+NLQ_MEMORY_DB = os.getenv("NLQ_MEMORY_DB", ".nlq_sql_memory.db")
+_NLQ_MEMORY_TOP_K = 3
+_NLQ_MEMORY_MIN_SIMILARITY = 0.4
+_NLQ_MEMORY_MAX_ROWS = 500
+
+
+def _nlq_memory_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(NLQ_MEMORY_DB)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS nlq_sql_memory ("
+        "id INTEGER PRIMARY KEY, nlq TEXT NOT NULL UNIQUE, "
+        "sql_text TEXT NOT NULL, created_at REAL NOT NULL)"
+    )
+    return conn
+
+
+def _nlq_tokens(question: str) -> set:
+    return set(re.findall(r"[a-z0-9]+", question.lower()))
+
+
+def _nlq_similarity(a: set, b: set) -> float:
+    """ Jaccard similarity between token sets. """
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _recall_nlq_examples(db_query: str) -> str:
+    """ Returns a few-shot preamble of the most similar prior successful
+    question->SQL pairs, or "" when nothing clears the threshold. """
+    try:
+        with _nlq_memory_connect() as conn:
+            rows = conn.execute("SELECT nlq, sql_text FROM nlq_sql_memory").fetchall()
+    except sqlite3.Error as e:
+        logger.warning("NLQ memory recall failed: %s", e)
+        return ""
+    query_tokens = _nlq_tokens(db_query)
+    scored = sorted(
+        ((_nlq_similarity(query_tokens, _nlq_tokens(nlq)), nlq, sql_text) for nlq, sql_text in rows),
+        reverse=True,
+    )
+    examples = [(nlq, sql_text) for score, nlq, sql_text in scored[:_NLQ_MEMORY_TOP_K]
+                if score >= _NLQ_MEMORY_MIN_SIMILARITY]
+    if not examples:
+        return ""
+    lines = [f"Q: {nlq}\nSQL: {sql_text}" for nlq, sql_text in examples]
+    return "Previous successful examples (question -> SQL):\n" + "\n".join(lines)
+
+
+def _remember_nlq_sql(db_query: str, response: dict) -> None:
+    """ Stores the final SQL the agent successfully executed for db_query. """
+    sql_text = None
+    for action, observation in response.get("intermediate_steps", []):
+        if getattr(action, "tool", None) != "sql_db_query":
+            continue
+        tool_input = action.tool_input
+        query = tool_input.get("query") if isinstance(tool_input, dict) else tool_input
+        if query and not str(observation).startswith("Error"):
+            sql_text = query
+    if not sql_text:
+        return
+    try:
+        with _nlq_memory_connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO nlq_sql_memory (nlq, sql_text, created_at) VALUES (?, ?, ?)",
+                (db_query, sql_text, time.time()),
+            )
+            # Keep the table bounded; oldest entries go first.
+            conn.execute(
+                "DELETE FROM nlq_sql_memory WHERE id NOT IN "
+                "(SELECT id FROM nlq_sql_memory ORDER BY created_at DESC LIMIT ?)",
+                (_NLQ_MEMORY_MAX_ROWS,),
+            )
+    except sqlite3.Error as e:
+        logger.warning("NLQ memory store failed: %s", e)
+
+
+# --- Templated DB Intents (agent bypass) ---
+# A handful of DB questions dominate traffic. Matching them against
+# pre-written parameterized SQL answers in one pooled DB round-trip
+# instead of the agent's 2-4 Gemini tool-calling round-trips (1-4s saved
+# per hit). The agent stays as the fallback for everything else.
+def _render_month_total(rows) -> str:
+    total = rows[0][0] if rows else 0
+    return f"You've spent {total:.2f} so far this month."
+
+
+def _render_top_categories(rows) -> str:
+    if not rows:
+        return "You have no categorized expenses recorded yet."
+    lines = [f"{i}. {name}: {total:.2f}" for i, (name, total) in enumerate(rows, 1)]
+    return "Your top spending categories:\n" + "\n".join(lines)
+
+
+def _render_savings_goals(rows) -> str:
+    if not rows:
+        return "You have no savings goals set up yet."
+    lines = []
+    for name, current, target in rows:
+        progress = f" ({current / target * 100:.0f}%)" if target else ""
+        lines.append(f"- {name}: {current:.2f} of {target:.2f}{progress}")
+    return "Your savings goals:\n" + "\n".join(lines)
+
+
+_INTENT_PATTERNS = [
+    (re.compile(r"\btotal\b.*\b(spen[dt]|expens)\w*\b.*\bthis month\b|\b(spen[dt]|expens)\w*\b.*\btotal\b.*\bthis month\b", re.IGNORECASE),
+     text("SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE user_id = :user_id AND date >= date_trunc('month', CURRENT_DATE)"),
+     _render_month_total),
+    (re.compile(r"\btop\b.*\bcategor(y|ies)\b", re.IGNORECASE),
+     text("SELECT ec.name, SUM(e.amount) AS total FROM expenses e JOIN expense_categories ec ON ec.id = e.category_id WHERE e.user_id = :user_id GROUP BY ec.name ORDER BY total DESC LIMIT 3"),
+     _render_top_categories),
+    (re.compile(r"\bsavings? goals?\b.*\b(progress|status|balance|doing)\b|\b(progress|status|balance)\b.*\bsavings? goals?\b", re.IGNORECASE),
+     text("SELECT name, current_amount, target_amount FROM savings_goals WHERE user_id = :user_id ORDER BY created_at"),
+     _render_savings_goals),
+]
+
+
+async def _run_templated_intent(db_query: str) -> Optional[str]:
+    """ Answers a DB question from a canned parameterized query if it matches
+    a known intent; returns None to fall through to the agent. """
+    for pattern, stmt, render in _INTENT_PATTERNS:
+        if pattern.search(db_query):
+            async with async_engine.connect() as conn:
+                result = await conn.execute(stmt, {"user_id": TEST_USER_ID})
+                rows = result.fetchall()
+            return render(rows)
+    return None
+
+
+async def _answer_query(user_query: str) -> str:
+    """ Routes and answers a single query, non-streaming. Shared by /chat_batch. """
+    user_query = user_query.strip()
+    if _query_over_budget(user_query):
+        return f"That question is too long - please keep it under {MAX_QUERY_CHARS} characters."
+    canned = _trivial_response(user_query)
+    if canned:
+        return canned
+    if user_query[:3].lower() == "db:":
+        db_query = user_query[3:].strip()
+        if not db_query:
+            return "Please provide a specific question about your data after 'DB:'."
+        rejected = _invalid_db_query_response(db_query)
+        if rejected:
+            return rejected
+        templated = await _run_templated_intent(db_query)
+        if templated is not None:
+            return templated
+        examples = await asyncio.to_thread(_recall_nlq_examples, db_query)
+        agent_input = {"input": db_query}
+        if examples:
+            agent_input["nlq_examples"] = [SystemMessage(content=examples)]
+        async with _GEMINI_SEM:
+            response = await agent_executor.ainvoke(agent_input)
+        await asyncio.to_thread(_remember_nlq_sql, db_query, response)
+        return response.get('output', "Sorry, I couldn't retrieve or process the database information.")
+
+    async with _GEMINI_SEM:
+        llm_response = await general_chain.ainvoke({"question": user_query})
+    return llm_response.content if hasattr(llm_response, 'content') else str(llm_response)
+
 # --- API Endpoints ---
 @app.get("/")
 async def root():
@@ -188,72 +649,132 @@ async def handle_chat(request: ChatRequest):
     """
     Handles chat requests. Uses HARDCODED TEST_USER_ID from .env file.
     Routes query to SQL agent (if prefixed with 'DB:') or General LLM.
-    Returns the chatbot's response.
+    Returns the chatbot's response as JSON; general questions may opt
+    into an SSE token stream via "stream": true.
     """
-    user_query = request.query
-    print("-" * 50)
-    print(f"Received request for /chat")
-    print(f"Raw Query: {user_query}")
-    print(f"❗ Acting as hardcoded User ID: {TEST_USER_ID}") # Log the user ID being used
+    user_query = request.query.strip()
+    logger.info("Received /chat request (as hardcoded user %s): %s", TEST_USER_ID, user_query)
 
     # Check if components initialized correctly on startup
-    if not agent_executor or not llm:
-         print("❌ ERROR: Chatbot components not initialized during startup.")
+    if not agent_executor or not llm or not llm_fast:
+         logger.error("Chatbot components not initialized during startup.")
          raise HTTPException(status_code=503, detail="Chatbot service is not ready.")
 
     # --- Authentication REMOVED ---
     # No token validation needed in this version
 
+    # --- Query Budget Guard (no LLM call) ---
+    if _query_over_budget(user_query):
+        logger.info("Rejecting oversized query (%d chars).", len(user_query))
+        raise HTTPException(status_code=413, detail=f"Query too long - please keep questions under {MAX_QUERY_CHARS} characters.")
+
+    # --- Trivial Input Short-Circuit (no LLM call) ---
+    canned = _trivial_response(user_query)
+    if canned:
+        logger.info("Trivial input - returning canned response without an LLM call.")
+        return ChatResponse(response=canned)
+
     # --- Processing ---
     output = "An unexpected error occurred."
     try:
         # --- Manual Routing Logic ---
-        if re.match(r"^\s*DB:", user_query, re.IGNORECASE):
+        # The prefix is a fixed 3-char literal, so a slice comparison beats
+        # the regex engine on this per-request hot path.
+        if user_query[:3].lower() == "db:":
             # --- Route to Database Agent ---
-            print(f"   Routing to Database Agent (as user: {TEST_USER_ID})")
-            db_query = re.sub(r"^\s*DB:", "", user_query, flags=re.IGNORECASE).strip()
+            logger.info("Routing to Database Agent (as user: %s)", TEST_USER_ID)
+            db_query = user_query[3:].strip()
 
             if not db_query:
                 output = "Please provide a specific question about your data after 'DB:'."
+            elif _invalid_db_query_response(db_query):
+                output = _invalid_db_query_response(db_query)
             else:
-                # --- Augment Input with HARDCODED UserID for the Agent ---
-                # Uses TEST_USER_ID loaded from .env at startup
-                augmented_input = f"UserID {TEST_USER_ID}: {db_query}"
-                print(f"   Augmented agent input: \"{augmented_input}\"")
-                agent_input = {"input": augmented_input}
-
-                # Invoke the SQL agent asynchronously
-                response = await agent_executor.ainvoke(agent_input)
-                output = response.get('output', "Sorry, I couldn't retrieve or process the database information.")
+                # Common questions match a templated intent and skip the
+                # agent's Gemini tool-calling loop entirely.
+                templated = await _run_templated_intent(db_query)
+                if templated is not None:
+                    logger.info("Answered via templated intent (no agent call).")
+                    output = templated
+                else:
+                    # UserID is bound server-side by UserScopedSQLQueryTool,
+                    # so the agent input is the user's question. Similar
+                    # previously-successful question->SQL pairs go in their
+                    # own prompt slot, not the memorized input.
+                    examples = await asyncio.to_thread(_recall_nlq_examples, db_query)
+                    agent_input = {"input": db_query}
+                    if examples:
+                        agent_input["nlq_examples"] = [SystemMessage(content=examples)]
+
+                    # Invoke the SQL agent asynchronously (rate-limited),
+                    # using the session's memory-backed agent when a
+                    # session_id is set
+                    session_agent = _get_agent_for_session(request.session_id)
+                    async with _GEMINI_SEM:
+                        response = await session_agent.ainvoke(agent_input)
+                    await asyncio.to_thread(_remember_nlq_sql, db_query, response)
+                    output = response.get('output', "Sorry, I couldn't retrieve or process the database information.")
 
         else:
             # --- Route to General LLM ---
-            print("   Routing to General LLM for concise answer...")
-            general_prompt = f"Answer the following financial question concisely, providing a helpful summary within a maximum of 4 lines:\n\nQuestion: {user_query}\n\nAnswer:"
-            llm_response = await llm.ainvoke(general_prompt)
-
-            if hasattr(llm_response, 'content'):
-                output = llm_response.content
-            else:
-                output = str(llm_response)
+            # Default: JSON ChatResponse via ainvoke, which is the contract
+            # the frontend expects AND the only path the LangChain response
+            # cache is consulted on (astream bypasses it). Clients that
+            # prefer time-to-first-token over cache hits opt in with
+            # "stream": true and get an SSE-framed token stream.
+            if request.stream:
+                logger.info("Routing to General LLM (streaming, uncached)...")
+
+                async def sse_stream():
+                    async with _GEMINI_SEM:
+                        async for chunk in general_chain.astream({"question": user_query}):
+                            if chunk.content:
+                                lines = chunk.content.splitlines() or [""]
+                                yield "".join(f"data: {line}\n" for line in lines) + "\n"
+
+                return StreamingResponse(sse_stream(), media_type="text/event-stream")
+
+            logger.info("Routing to General LLM for concise answer...")
+            async with _GEMINI_SEM:
+                llm_response = await general_chain.ainvoke({"question": user_query})
+            output = llm_response.content if hasattr(llm_response, 'content') else str(llm_response)
 
     except Exception as e:
-        print(f"❌ Error processing query (as user {TEST_USER_ID}): {e}")
+        logger.error("Error processing query (as user %s): %s", TEST_USER_ID, e)
         raise HTTPException(status_code=500, detail="An internal error occurred while processing your request.")
 
     # --- Return Response ---
-    print(f"   Responding with (first 100 chars): {output[:100]}...")
-    print("-" * 50)
+    logger.info("Responding with (first 100 chars): %.100s...", output)
     return ChatResponse(response=output)
 
 
+@app.post("/chat_batch", response_model=ChatBatchResponse)
+async def handle_chat_batch(request: ChatBatchRequest):
+    """
+    Answers a batch of queries concurrently (bounded by _GEMINI_SEM).
+    Intended for bulk evaluation runs, not interactive chat.
+    """
+    if not agent_executor or not llm or not llm_fast:
+        raise HTTPException(status_code=503, detail="Chatbot service is not ready.")
+    try:
+        responses = await asyncio.gather(*[_answer_query(q) for q in request.queries])
+    except Exception as e:
+        logger.error("Error processing batch of %d queries: %s", len(request.queries), e)
+        raise HTTPException(status_code=500, detail="An internal error occurred while processing the batch.")
+    return ChatBatchResponse(responses=list(responses))
+
+
 # --- Main Execution Block ---
 if __name__ == "__main__":
-    # Check if all critical components were initialized successfully
-    # Removed supabase_client check
-    if llm and db and toolkit and agent_executor:
-        print("✅ All components initialized successfully.")
-        print("--- Starting FastAPI Server (Hardcoded User Mode) ---")
-        uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
-    else:
-        print("❌ FastAPI server cannot start due to initialization errors. Please check logs.")
+    # Component initialization happens in the lifespan handler (per worker);
+    # endpoints answer 503 if it failed.
+    print("--- Starting FastAPI Server (Hardcoded User Mode) ---")
+    # Multiple workers give true process parallelism on top of the
+    # per-worker async concurrency (requires the app as an import string).
+    uvicorn.run(
+        "financial_chatbot:app",
+        host="0.0.0.0",
+        port=8000,
+        log_level="info",
+        workers=int(os.getenv("UVICORN_WORKERS", "4")),
+    )